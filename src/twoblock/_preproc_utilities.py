@@ -5,14 +5,33 @@ Created on Sat Dec 21 10:55:24 2019
 
 Set of help functions for robust centring and scaling 
 
+The column-wise estimators (median, mean, std, mad, scaleTau2) reduce
+along axis 0 and are fastest on Fortran-ordered (column-major) input,
+which callers can pass as is. This does not hold for l1median and
+kstepLTS, which work on rows and copy large input to C order when the
+numba kernels are used.
+
 @author: Sven Serneels, Ponalytics
 """
 
 import numpy as np
-import pandas as ps
 import scipy.stats as sps
 import scipy.optimize as spo
-import copy
+
+try:
+    from numba import get_num_threads, njit, prange
+
+    _HAS_NUMBA = True
+except ImportError:
+    # numba is optional, NumPy fallbacks are used when it is absent
+    _HAS_NUMBA = False
+
+# Standard normal quantile at 3/4, consistency factor for MAD and tau scale
+_PHI_INV_75 = 0.6744897501960817
+
+# Number of entries in X from which the numba kernels are used. Below this,
+# loading the compiled kernels costs more than they save over NumPy
+_NUMBA_MIN_SIZE = 2000000
 
 
 def _handle_zeros_in_scale(scale, copy=True):
@@ -40,41 +59,50 @@ def _check_trimming(t):
         raise (ValueError("Trimming fraction must be in [0,1)"))
 
 
-def mad(X, c=0.6744897501960817, **kwargs):
+def mad(X, c=_PHI_INV_75, **kwargs):
     """
     Column-wise median absolute deviation. **kwargs included to allow
     general function call in scale_data.
     """
 
-    s = median(np.abs(X - median(X, axis=0)), axis=0) / c
-    s = np.array(s).reshape(-1)
+    if np.isnan(X).any():
+        med = np.nanmedian
+    else:
+        med = np.median
+    s = med(np.abs(X - med(X, axis=0)), axis=0) / c
+    s = np.asarray(s).ravel()
     # statsmodels.robust.mad is not as flexible toward matrix input,
     # sometimes throws a value error in ufunc
     return s
 
 
-def median(X, **kwargs):
+def median(X, has_nan=None, **kwargs):
     """
     Column-wise median. **kwargs included to allow
-    general function call in scale_data.
+    general function call in scale_data. Callers that already know
+    whether X contains NaNs can pass has_nan to skip the scan.
     """
 
-    if np.isnan(X).any():
+    if has_nan is None:
+        has_nan = np.isnan(X).any()
+    if has_nan:
         m = np.nanmedian(X, axis=0)
     else:
         m = np.median(X, axis=0)
-    m = np.array(m).reshape(-1)
+    m = np.asarray(m).ravel()
 
     return m
 
 
-def mean(X, trimming=0):
+def mean(X, trimming=0, has_nan=None):
     """
     Column-wise mean or trimmed mean. Trimming to be entered as fraction.
     """
 
     if trimming == 0:
-        if np.isnan(X).any():
+        if has_nan is None:
+            has_nan = np.isnan(X).any()
+        if has_nan:
             m = np.nanmean(X, axis=0)
         else:
             m = np.mean(X, axis=0)
@@ -85,18 +113,21 @@ def mean(X, trimming=0):
     return m
 
 
-def std(X, trimming=0):
+def std(X, trimming=0, has_nan=None):
     """
     Column-wise standard devaition or trimmed std.
     Trimming to be entered as fraction.
     """
 
     if trimming == 0:
-        if np.isnan(X).any():
-            s = np.power(np.nanvar(X, axis=0), 0.5)
+        if has_nan is None:
+            has_nan = np.isnan(X).any()
+        if has_nan:
+            s = np.nanvar(X, axis=0)
         else:
-            s = np.power(np.var(X, axis=0), 0.5)
-        s = np.array(s).reshape(-1)
+            s = np.var(X, axis=0)
+        s = np.sqrt(s)
+        s = np.asarray(s).ravel()
     else:
         var = sps.trim_mean(
             np.square(X - sps.trim_mean(X, trimming, 0)), trimming, 0
@@ -105,69 +136,230 @@ def std(X, trimming=0):
     return s
 
 
-def _euclidnorm(x):
+class _L1mObjective:
     """
-    Euclidean norm of a vector
+    Optimization objective and Jacobian for l1median, evaluated together
+    for use with jac=True in scipy.optimize.minimize. The matrix of
+    differences and the vector of distances are allocated once and reused
+    across all evaluations by the optimizer. Missing entries in X are
+    ignored.
     """
 
-    if np.isnan(x).any():
-        return np.sqrt(np.nansum(np.square(x)))
-    else:
-        return np.sqrt(np.sum(np.square(x)))
-
-
-def _diffmat_objective(a, X):
+    def __init__(self, X, has_nan=None):
+        self.X = X
+        if has_nan is None:
+            has_nan = np.isnan(X).any()
+        self._missing = np.isnan(X) if has_nan else None
+        self._dX = np.empty(X.shape)
+        self._dists = np.empty(X.shape[0])
+
+    def _distances(self, a):
+        np.subtract(self.X, a, out=self._dX)
+        if self._missing is not None:
+            self._dX[self._missing] = 0.0
+        np.einsum("ij,ij->i", self._dX, self._dX, out=self._dists)
+        np.sqrt(self._dists, out=self._dists)
+        return self._dX, self._dists
+
+    def objective_and_jacobian(self, a, *args):
+        """
+        Objective and Jacobian at a, sharing one distance computation.
+        """
+
+        dX, dists = self._distances(a)
+        fun = np.sum(dists)
+        dX /= _handle_zeros_in_scale(dists, copy=False)[:, None]
+        return fun, -np.sum(dX, axis=0)
+
+
+class _WeiszfeldUpdate:
     """
-    Utility to l1median, matrix of differences
+    Vardi-Zhang step for l1median. The matrix of differences is allocated
+    once and reused across all steps. Entries flagged in the boolean
+    matrix missing are ignored.
     """
 
-    (n, p) = X.shape
-    return X - np.tile(a, (n, 1))
-
-
-def _l1m_objective(a, X, *args):
+    def __init__(self, X, missing=None):
+        self.X = X
+        if missing is None:
+            self._observed = None
+            self._dX = np.empty(X.shape)
+        else:
+            self._observed = ~missing
+            self._observed_f = self._observed.astype(np.float64)
+            # missing positions are never written to and stay zero
+            self._dX = np.zeros(X.shape)
+
+    def _differences(self, a):
+        if self._observed is None:
+            np.subtract(self.X, a, out=self._dX)
+        else:
+            np.subtract(self.X, a, out=self._dX, where=self._observed)
+        return self._dX
+
+    def objective(self, a):
+        dX = self._differences(a)
+        return np.sum(np.sqrt(np.einsum("ij,ij->i", dX, dX)))
+
+    def step(self, a, out_a):
+        """
+        One step from a, written into out_a.
+        """
+
+        n = self.X.shape[0]
+        dX = self._differences(a)
+        dists = np.sqrt(np.einsum("ij,ij->i", dX, dX))
+        nonzero = dists > 0
+        w = np.zeros(n)
+        w[nonzero] = 1 / dists[nonzero]
+        if self._observed is not None:
+            wsum = w @ self._observed_f
+        else:
+            wsum = w.sum()
+        R = w @ dX
+        T = a + R / _handle_zeros_in_scale(wsum)
+        eta = n - np.count_nonzero(nonzero)
+        if eta == 0:
+            out_a[:] = T
+        else:
+            # Vardi-Zhang correction: the current estimate is a data point
+            r = np.linalg.norm(R)
+            gamma = 1.0 if r == 0 else min(1.0, eta / r)
+            out_a[:] = (1 - gamma) * T + gamma * a
+
+
+if _HAS_NUMBA:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _weiszfeld_step(X, a, out_a, nblocks):
+        """
+        Compiled equivalent of _WeiszfeldUpdate.step for data without
+        missing values. The rows are split into nblocks blocks, one per
+        thread. Each block is visited in a single pass, accumulating the
+        weighted differences and weights, and the per-block sums are
+        reduced afterwards.
+        """
+
+        n, p = X.shape
+        R_blocks = np.zeros((nblocks, p))
+        wsum_blocks = np.zeros(nblocks)
+        eta_blocks = np.zeros(nblocks, dtype=np.int64)
+        for b in prange(nblocks):
+            d = np.empty(p)
+            for i in range(b * n // nblocks, (b + 1) * n // nblocks):
+                ss = 0.0
+                for j in range(p):
+                    d[j] = X[i, j] - a[j]
+                    ss += d[j] * d[j]
+                if ss > 0:
+                    w = 1 / np.sqrt(ss)
+                    wsum_blocks[b] += w
+                    for j in range(p):
+                        R_blocks[b, j] += w * d[j]
+                else:
+                    eta_blocks[b] += 1
+        R = R_blocks.sum(axis=0)
+        wsum = wsum_blocks.sum()
+        eta = eta_blocks.sum()
+        if wsum == 0:
+            wsum = 1.0
+        gamma = 0.0
+        if eta > 0:
+            r = np.sqrt(np.sum(R * R))
+            gamma = 1.0 if r == 0 else min(1.0, eta / r)
+        for j in range(p):
+            out_a[j] = a[j] + (1 - gamma) * R[j] / wsum
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _kstep_lts_inner(X, m):
+        """
+        Squared Euclidean distances of the rows of X to m
+        """
+
+        n, p = X.shape
+        dists = np.empty(n)
+        for i in prange(n):
+            ss = 0.0
+            for j in range(p):
+                d = X[i, j] - m[j]
+                ss += d * d
+            dists[i] = ss
+        return dists
+
+
+def _l1median_weiszfeld(X, x0, tol=1e-8, maxiter=2000, has_nan=None):
     """
-    Optimization objective for l1median
+    Spatial median by the Vardi-Zhang modified Weiszfeld iteration.
+    Each step is a reweighted mean of the data with weights 1/||x_i - a||,
+    corrected for data points that coincide with the current estimate.
+    Missing entries are ignored, both in the distances and in the means.
+    Uses a numba kernel for large complete data when numba is installed.
+    Returns a scipy.optimize.OptimizeResult for compatibility with
+    spo.minimize.
     """
 
-    if np.isnan(X).any():
-        return np.nansum(
-            np.apply_along_axis(_euclidnorm, 1, _diffmat_objective(a, X))
-        )
-    else:
-        return np.sum(
-            np.apply_along_axis(_euclidnorm, 1, _diffmat_objective(a, X))
-        )
-
+    if has_nan is None:
+        has_nan = np.isnan(X).any()
+    missing = np.isnan(X) if has_nan else None
+    if has_nan:
+        # fully missing rows carry no information, yet would have zero
+        # distance to any estimate and trigger the Vardi-Zhang correction
+        empty_rows = missing.all(axis=1)
+        if empty_rows.any():
+            X = X[~empty_rows]
+            missing = missing[~empty_rows]
+    use_jit = _HAS_NUMBA and not has_nan and X.size >= _NUMBA_MIN_SIZE
+    if use_jit:
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        nblocks = min(X.shape[0], get_num_threads())
+    update = _WeiszfeldUpdate(X, missing)
+    a = np.array(x0, dtype=np.float64).reshape(-1)
+    a_new = np.empty_like(a)
+    converged = False
+    iteration = 0
+    while not converged and (iteration < maxiter):
+        if use_jit:
+            _weiszfeld_step(X, a, a_new, nblocks)
+        else:
+            update.step(a, a_new)
+        converged = np.linalg.norm(a_new - a) < tol
+        a, a_new = a_new, a
+        iteration += 1
+    fun = update.objective(a)
 
-def _l1m_jacobian(a, X):
-    """
-    Jacobian for l1median
-    """
-
-    (n, p) = X.shape
-    dX = _diffmat_objective(a, X)
-    dists = np.apply_along_axis(_euclidnorm, 1, dX)
-    dists = _handle_zeros_in_scale(dists)
-    dX /= np.tile(np.array(dists).reshape(n, 1), (1, p))
-    if np.isnan(X).any():
-        return -np.nansum(dX, axis=0)
-    else:
-        return -np.sum(dX, axis=0)
+    return spo.OptimizeResult(x=a, fun=fun, nit=iteration, success=converged)
 
 
 def _l1median(
-    X, x0, method="SLSQP", tol=1e-8, options={"maxiter": 2000}, **kwargs
+    X,
+    x0,
+    method="weiszfeld",
+    tol=1e-8,
+    options={"maxiter": 2000},
+    has_nan=None,
+    **kwargs
 ):
     """
-    Optimization for l1median
+    Optimization for l1median. The default method is the Vardi-Zhang
+    iteration; any other method is passed on to scipy.optimize.minimize,
+    for which "L-BFGS-B" is the recommended choice as the problem is
+    unconstrained.
     """
 
+    if method == "weiszfeld":
+        return _l1median_weiszfeld(
+            X,
+            x0,
+            tol=tol,
+            maxiter=options.get("maxiter", 2000),
+            has_nan=has_nan,
+        )
+
+    l1m = _L1mObjective(X, has_nan)
     mu = spo.minimize(
-        _l1m_objective,
+        l1m.objective_and_jacobian,
         x0,
-        args=(X),
-        jac=_l1m_jacobian,
+        jac=True,
         tol=tol,
         options=options,
         method=method,
@@ -181,23 +373,37 @@ def l1median(X, **kwargs):
     optimization options will crash when provided matrix input.
     """
 
-    if "x0" not in kwargs:
-        x0 = median(X)
-
     if type(X) == np.matrix:
         X = np.array(X)
 
+    if kwargs.get("has_nan") is None:
+        kwargs["has_nan"] = np.isnan(X).any()
+
     if len(X.shape) == 2:
         (n, p) = X.shape
     else:
         p = 1
 
     if p < 2:
-        return median(X)
+        return median(X, has_nan=kwargs["has_nan"])
     else:
+        if "x0" in kwargs:
+            x0 = kwargs.pop("x0")
+        else:
+            x0 = median(X, has_nan=kwargs["has_nan"])
         return _l1median(X, x0, **kwargs).x
 
 
+def _lts_hsubset(dists, h):
+    """
+    Indices of the h + 1 smallest distances. Found by partitioning rather
+    than a full sort; ties at the cut-off are broken arbitrarily, so the
+    subset always has exactly h + 1 elements.
+    """
+
+    return np.argpartition(dists, h)[: h + 1]
+
+
 def kstepLTS(X, maxit=5, tol=1e-10, **kwargs):
     """
     Computes the K-step LTS estimator of location
@@ -212,21 +418,29 @@ def kstepLTS(X, maxit=5, tol=1e-10, **kwargs):
         m2: location estimate
     """
     n, p = X.shape
-    m1 = l1median(X)  # initial estimate
-    m2 = copy.deepcopy(m1)
+    has_nan = np.isnan(X).any()
+    use_jit = _HAS_NUMBA and not has_nan and X.size >= _NUMBA_MIN_SIZE
+    if use_jit:
+        X = np.ascontiguousarray(X, dtype=np.float64)
+    m1 = l1median(X, has_nan=has_nan)  # initial estimate
+    m2 = m1.copy()
+    h = int(np.floor((n + 1) / 2)) - 1
     iteration = 0
     unconverged = True
     while unconverged and (iteration < maxit):
-        if np.isnan(X).any():
-            dists = np.nansum(np.square(X - m1), axis=1)
+        if use_jit:
+            dists = _kstep_lts_inner(X, m1)
         else:
-            dists = np.sum(np.square(X - m1), axis=1)
-        cutdist = np.sort(dists, axis=0)[int(np.floor((n + 1) / 2)) - 1]
-        hsubset = np.where(dists <= cutdist)[0]
-        m2 = np.array(mean(X[hsubset, :])).reshape((p,))
+            dX = X - m1
+            if has_nan:
+                dists = np.nansum(dX * dX, axis=1)
+            else:
+                dists = np.einsum("ij,ij->i", dX, dX)
+        hsubset = _lts_hsubset(dists, h)
+        m2 = np.asarray(mean(X[hsubset, :], has_nan=has_nan)).ravel()
         unconverged = max(abs(m1 - m2)) > tol
         iteration += 1
-        m1 = copy.deepcopy(m2)
+        np.copyto(m1, m2)
 
     return m2
 
@@ -244,44 +458,44 @@ def scaleTau2(x0, c1=4.5, c2=3, consistency=True, **kwargs):
         the scale estimate
     """
 
-    x = copy.deepcopy(x0)
+    # working copy in column-major order, all reductions are column-wise
+    x = np.array(x0, copy=True, order="F")
     n, p = x.shape
-    if np.isnan(x).any():
+    has_nan = np.isnan(x).any()
+    if has_nan:
         summ = np.nansum
     else:
         summ = np.sum
-    medx = median(x)
+    medx = median(x, has_nan=has_nan)
     xc = abs(x - medx)
-    sigma0 = median(xc)
+    sigma0 = median(xc, has_nan=has_nan)
     if c1 > 0:
         xc /= sigma0 * c1
-        w = 1 - np.square(xc)
-        w = np.square((abs(w) + w) / 2)
-        mu = summ(np.multiply(x, w)) / summ(w)
+        # Tukey biweight, max(1 - xc^2, 0)^2 computed in place
+        w = 1.0 - xc * xc
+        np.maximum(w, 0.0, out=w)
+        w *= w
+        mu = summ(x * w, axis=0) / summ(w, axis=0)
     else:
         mu = medx
     x -= mu
     x /= sigma0
     rho = np.square(x)
-    rho[np.where(rho > c2**2)[0]] = c2**2
+    rho = np.minimum(rho, c2**2)
     if consistency:
-
-        def Erho(b):
-            return (
-                2 * ((1 - b**2) * sps.norm.cdf(b) - b * sps.norm.pdf(b) + b**2)
-                - 1
-            )
-
-        def Es2(c2):
-            return Erho(c2 * sps.norm.ppf(3 / 4))
-
+        # E[rho] under the normal model, evaluated at b = c2 * Phi^-1(3/4)
+        b = c2 * _PHI_INV_75
+        Es2 = (
+            2 * ((1 - b * b) * sps.norm.cdf(b) - b * sps.norm.pdf(b) + b * b)
+            - 1
+        )
         if consistency == "finiteSample":
-            nEs2 = (n - 2) * Es2(c2)
+            nEs2 = (n - 2) * Es2
         else:
-            nEs2 = n * Es2(c2)
+            nEs2 = n * Es2
     else:
         nEs2 = n
-    return np.array(sigma0 * np.sqrt(summ(rho) / nEs2)).reshape((p,))
+    return (sigma0 * np.sqrt(summ(rho, axis=0) / nEs2)).ravel()
 
 
 def scale_data(X, m, s):
@@ -290,19 +504,16 @@ def scale_data(X, m, s):
 
     """
 
-    n = X.shape
-    if len(n) > 1:
-        p = n[1]
+    if len(X.shape) > 1:
+        p = X.shape[1]
     else:
         p = 1
-    n = n[0]
 
     s = _handle_zeros_in_scale(s)
 
     if p == 1:
-        Xm = X - float(m)
-        Xs = Xm / s
+        # 0-d arrays broadcast without a round trip through Python floats
+        Xs = (X - np.asarray(m).reshape(())) / np.asarray(s).reshape(())
     else:
-        Xm = X - np.array([m for i in range(1, n + 1)])
-        Xs = Xm / np.array([s for i in range(1, n + 1)])
+        Xs = (X - np.asarray(m)) / np.asarray(s)
     return Xs
@@ -31,7 +31,8 @@
 #         -   `median(X)`: Column-wise median.
 #         -   `l1median(X)`: L1 or spatial median. Optional arguments:
 #         -   `x0`: starting point for optimization, defaults to column wise median
-#         -   `method`: optimization algorithm, defaults to 'SLSQP'
+#         -   `method`: optimization algorithm, defaults to 'weiszfeld' (Vardi-Zhang
+#             iteration); other values, e.g. 'L-BFGS-B', are passed to `scipy.optimize.minimize`
 #         -   `tol`: tolerance, defaults to 1e-8
 #         -   `options`: list of options for `scipy.optimize.minimize`
 #         -   `kstepLTS(X): k-step LTS estimator of location.
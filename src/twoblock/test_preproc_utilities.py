@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the robust centring and scaling helpers
+
+@author: Sven Serneels
+"""
+
+import unittest
+import numpy as np
+from ._preproc_utilities import (
+    l1median,
+    kstepLTS,
+    scaleTau2,
+    _lts_hsubset,
+    _WeiszfeldUpdate,
+    _HAS_NUMBA,
+)
+
+if _HAS_NUMBA:
+    from ._preproc_utilities import _weiszfeld_step
+
+
+class TestL1median(unittest.TestCase):
+    """Test the Weiszfeld iteration in l1median against scipy.optimize"""
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.X = rng.standard_normal((200, 5))
+        self.Xn = self.X.copy()
+        self.Xn[rng.random(self.X.shape) < 0.05] = np.nan
+
+    def test_complete(self):
+
+        np.testing.assert_allclose(
+            l1median(self.X), l1median(self.X, method="SLSQP"), atol=1e-4
+        )
+
+    def test_missing(self):
+
+        np.testing.assert_allclose(
+            l1median(self.Xn), l1median(self.Xn, method="SLSQP"), atol=1e-4
+        )
+
+    def test_missing_row(self):
+        """A fully missing row should not affect the estimate"""
+
+        Xr = self.Xn.copy()
+        Xr[3, :] = np.nan
+        m = l1median(Xr)
+        np.testing.assert_allclose(m, l1median(np.delete(self.Xn, 3, 0)))
+        np.testing.assert_allclose(
+            m, l1median(Xr, method="SLSQP"), atol=1e-4
+        )
+
+
+@unittest.skipUnless(_HAS_NUMBA, "numba is not installed")
+class TestWeiszfeldStep(unittest.TestCase):
+    """Test the numba kernel against the NumPy Weiszfeld step"""
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.X = rng.standard_normal((100, 4))
+
+    def _compare(self, a):
+        out_np = np.empty(4)
+        out_nb = np.empty(4)
+        _WeiszfeldUpdate(self.X).step(a, out_np)
+        _weiszfeld_step(self.X, a, out_nb, 3)
+        np.testing.assert_allclose(out_nb, out_np, rtol=1e-10, atol=1e-12)
+
+    def test_step(self):
+
+        self._compare(np.median(self.X, axis=0))
+
+    def test_step_at_data_point(self):
+        """Vardi-Zhang correction when the estimate is a data point"""
+
+        self._compare(self.X[5, :].copy())
+
+
+class TestKstepLTS(unittest.TestCase):
+    """Test the h-subset selection in kstepLTS when distances tie"""
+
+    def setUp(self):
+        # every row appears three times, so distances tie in triples and
+        # the cut-off at h + 1 = 152 rows splits a group of tied rows
+        rng = np.random.default_rng(4)
+        self.X = np.repeat(rng.standard_normal((101, 3)), 3, axis=0)
+        self.h = int(np.floor((self.X.shape[0] + 1) / 2)) - 1
+
+    def test_hsubset_size(self):
+
+        dists = np.sum(np.square(self.X - l1median(self.X)), axis=1)
+        hsubset = _lts_hsubset(dists, self.h)
+        self.assertEqual(len(hsubset), self.h + 1)
+        self.assertEqual(len(np.unique(hsubset)), self.h + 1)
+        cutdist = np.sort(dists)[self.h]
+        self.assertTrue(np.all(dists[hsubset] <= cutdist))
+        # the sort-based selection keeps all rows tied at the cut-off
+        self.assertGreater(np.sum(dists <= cutdist), self.h + 1)
+
+    def test_close_to_sort(self):
+        """Estimate stays close to the sort-based h-subset selection"""
+
+        m1 = l1median(self.X)
+        for iteration in range(5):
+            dists = np.sum(np.square(self.X - m1), axis=1)
+            cutdist = np.sort(dists)[self.h]
+            m2 = np.mean(self.X[dists <= cutdist, :], axis=0)
+            if max(abs(m1 - m2)) <= 1e-10:
+                break
+            m1 = m2
+        np.testing.assert_allclose(kstepLTS(self.X), m2, atol=0.05)
+
+
+class TestScaleTau2(unittest.TestCase):
+    """Test column-wise evaluation of the tau scale"""
+
+    def test_columnwise(self):
+
+        rng = np.random.default_rng(3)
+        X = rng.standard_normal((100, 4)) * [1, 2, 0.5, 3]
+        s = scaleTau2(X)
+        self.assertEqual(s.shape, (4,))
+        np.testing.assert_allclose(
+            s, np.concatenate([scaleTau2(X[:, [j]]) for j in range(4)])
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()